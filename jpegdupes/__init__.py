@@ -1 +1,3 @@
 name = "jpegdupes"
+
+from .jpegdupes import Scanner, SignatureIndex
@@ -1,19 +1,27 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 import argparse
+import asyncio
 import contextlib
 import hashlib
+import heapq
+import itertools
+import json
 import os
 import pickle
 import shutil
+import struct
 import subprocess as sub
 import sys
 import tempfile
+import threading
 import time
 import zlib
-from collections import defaultdict
+from collections import defaultdict, deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from io import BytesIO
-from multiprocessing import Pool
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
 from subprocess import DEVNULL, check_call
 
 import gi
@@ -28,34 +36,54 @@ VERSION = "2.1"
 
 JPEG_CACHE_FILE = "/.signatures"
 
+# Default number of threads reading files from disk
+IO_THREADS = 2
 
+# Files kept read ahead in shared memory for each hashing process
+READAHEAD_DEPTH = 2
 
-# a context manager to do work within given directory
-@contextlib.contextmanager
-def in_dir(path):
-    cwd = os.getcwd()
-    os.chdir(path)
-    try:
-        yield
-    except OSError:
-        sys.stderr.write("Directory %s doesn't exist\n" % path)
-        exit(1)
-    finally:
-        os.chdir(cwd)
+# Default memory used for grouping signatures before spilling them to disk (MB)
+MEMORY_LIMIT = 256
+
+# Fixed-width (digest, file id) records used for grouping. MD5 digests fit
+# exactly, CRCs are padded
+GROUP_RECORD = struct.Struct(">16sQ")
+
+# ionice arguments for each I/O scheduling class allowed for scans
+IONICE_CLASSES = {
+    "best-effort": ["-c", "2", "-n", "7"],
+    "idle": ["-c", "3"],
+}
 
+# Adaptive backoff: reads slow down when the average read latency rises
+# above BACKOFF_FACTOR times the lowest average seen (after some warm up)
+BACKOFF_FACTOR = 2
+BACKOFF_WARMUP = 10
+BACKOFF_MAX_DELAY = 1.0
 
+# A context manager providing the process pool for hash calculation. If the
+# caller gives its own executor it's used as is, and it's up to the caller
+# to shut it down
+# Hashing processes run with the priorities set in throttle, if any
 @contextlib.contextmanager
-def a_thread_pool():
-    pool = Pool()
+def a_thread_pool(processes=None, executor=None, throttle=None):
+    if executor is not None:
+        yield executor
+        return
+    if throttle is not None:
+        pool = ProcessPoolExecutor(
+            processes, initializer=lower_priority, initargs=(throttle.niceness, throttle.ioclass)
+        )
+    else:
+        pool = ProcessPoolExecutor(processes)
     try:
         yield pool
     finally:
-        pool.close()
+        pool.shutdown()
 
 
 # Calculates hash of the specified object x. x is a tuple with the format
 # (JPEGImage object,rotation,hash_method)
-# This is the function that will be executed in the process pool
 def phash(x):
     img = x[0]
     rot = x[1]
@@ -86,11 +114,225 @@ def phash(x):
     return h
 
 
+# Lowers CPU (nice) and I/O (ionice) priority of the calling thread. Used as
+# initializer of the I/O threads and hashing processes
+def lower_priority(niceness=None, ioclass=None):
+    tid = threading.get_native_id()
+    if niceness is not None:
+        try:
+            os.setpriority(os.PRIO_PROCESS, tid, niceness)
+        except OSError:
+            sys.stderr.write("Can't set nice value %d\n" % niceness)
+    if ioclass is not None:
+        try:
+            check_call(
+                ["ionice"] + IONICE_CLASSES[ioclass] + ["-p", str(tid)],
+                stdout=DEVNULL,
+                stderr=DEVNULL,
+            )
+        except (sub.CalledProcessError, FileNotFoundError):
+            sys.stderr.write("Can't set I/O scheduling class %s\n" % ioclass)
+
+
+# Token bucket allowing rate units per second on average, with bursts of up
+# to one second worth of units. Safe to share between threads
+class TokenBucket:
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.stamp = time.monotonic()
+        self.lock = threading.Lock()
+
+    def take(self, n):
+        """ Takes n units, waiting as needed. Requests bigger than the bucket
+            leave it in debt, delaying later ones. Returns the time waited.
+        """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+            self.tokens -= n
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+class Throttle:
+    """ Schedules file reads within bytes/sec and files/sec budgets (either
+        may be None for no limit). If backoff is enabled, reads are delayed
+        further while the observed read latency is high, which usually means
+        the storage is busy serving others. niceness and ioclass (a key of
+        IONICE_CLASSES) lower the priority of I/O threads and hashing processes.
+    """
+
+    def __init__(self, bytes_rate=None, files_rate=None, backoff=False, niceness=None, ioclass=None):
+        self.bytes = TokenBucket(bytes_rate) if bytes_rate else None
+        self.files = TokenBucket(files_rate) if files_rate else None
+        self.backoff = backoff
+        self.niceness = niceness
+        self.ioclass = ioclass
+        self.lock = threading.Lock()
+        # Extra delay before each read, adjusted by the adaptive backoff
+        self.delay = 0.0
+        # Moving average of read latency, in seconds per MB, and its minimum
+        self.latency = None
+        self.baseline = None
+        self.start = time.monotonic()
+        self.nfiles = 0
+        self.nbytes = 0
+        self.samples = 0
+        self.waited = 0.0
+        self.backoffs = 0
+
+    def before_read(self, size):
+        """ Waits until a file of the given size can be read. """
+        waited = self.delay
+        if self.delay:
+            time.sleep(self.delay)
+        if self.files is not None:
+            waited += self.files.take(1)
+        if self.bytes is not None:
+            waited += self.bytes.take(size)
+        with self.lock:
+            self.waited += waited
+
+    def after_read(self, size, elapsed):
+        """ Accounts for a finished read, adapting the backoff delay. """
+        # Small files count as 64 KB, seek time dominates anyway
+        latency = elapsed * 1024 * 1024 / max(size, 65536)
+        with self.lock:
+            self.nfiles += 1
+            self.nbytes += size
+            self.samples += 1
+            if self.latency is None:
+                self.latency = latency
+            else:
+                self.latency = 0.8 * self.latency + 0.2 * latency
+            if not self.backoff or self.samples < BACKOFF_WARMUP:
+                return
+            if self.baseline is None or self.latency < self.baseline:
+                self.baseline = self.latency
+            if self.latency > BACKOFF_FACTOR * self.baseline:
+                # Multiplicative increase of delay while storage is slow
+                self.delay = min(BACKOFF_MAX_DELAY, max(0.01, self.delay * 2))
+                self.backoffs += 1
+            elif self.delay:
+                # ...and slow recovery once it's back to normal
+                self.delay = self.delay / 2 if self.delay > 0.001 else 0.0
+
+    def stats(self):
+        """ Returns a dict with throttling statistics so far. """
+        with self.lock:
+            elapsed = time.monotonic() - self.start
+            return {
+                "files": self.nfiles,
+                "bytes": self.nbytes,
+                "elapsed": elapsed,
+                "files_rate": self.nfiles / elapsed if elapsed else 0.0,
+                "bytes_rate": self.nbytes / elapsed if elapsed else 0.0,
+                "waited": self.waited,
+                "backoffs": self.backoffs,
+                "latency": self.latency,
+            }
+
+
+# Attaches to an existing shared memory block created by the I/O threads.
+# The main process owns the block and will unlink it, so the worker must not
+# register it with the resource tracker (it would try to clean it up too)
+def attach_shared(name):
+    try:
+        return SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 has no track parameter
+        shm = SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+# Frees a shared memory block created by read_shared
+def release_shared(shm):
+    shm.close()
+    shm.unlink()
+
+
+# Reads a whole file into a new shared memory block, so hashing processes
+# can get its contents without them being pickled through a pipe.
+# Reads are scheduled by throttle, if given.
+# Returns a tuple (SharedMemory object, data size), or (None, 0) if the
+# file can't be read
+def read_shared(path, throttle=None):
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return None, 0
+    with open(fd, "rb", buffering=0) as f:
+        if hasattr(os, "posix_fadvise"):
+            # The file will be read just once, from start to end
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        size = os.fstat(fd).st_size
+        if throttle is not None:
+            throttle.before_read(size)
+        started = time.monotonic()
+        shm = SharedMemory(create=True, size=max(size, 1))
+        nread = 0
+        try:
+            while nread < size:
+                with shm.buf[nread:size] as chunk:
+                    n = f.readinto(chunk)
+                if not n:
+                    # File was truncated while reading it
+                    break
+                nread += n
+        except OSError:
+            release_shared(shm)
+            return None, 0
+    if throttle is not None:
+        throttle.after_read(nread, time.monotonic() - started)
+    return shm, nread
+
+
+# Reads the given files in order using a pool of I/O threads, keeping at
+# most depth files read ahead. items are tuples whose first element is the
+# file path. Yields (item, SharedMemory object, data size) tuples in the same
+# order, and the caller is responsible of releasing each shared memory block.
+# Reads are scheduled by throttle, if given
+def read_ahead(items, io_threads, depth, throttle=None):
+    inflight = deque()
+    if throttle is not None:
+        readers = ThreadPoolExecutor(
+            io_threads, initializer=lower_priority, initargs=(throttle.niceness, throttle.ioclass)
+        )
+    else:
+        readers = ThreadPoolExecutor(io_threads)
+    with readers:
+        try:
+            for item in items:
+                inflight.append((item, readers.submit(read_shared, item[0], throttle)))
+                if len(inflight) >= depth:
+                    item, fut = inflight.popleft()
+                    yield (item,) + fut.result()
+            while inflight:
+                item, fut = inflight.popleft()
+                yield (item,) + fut.result()
+        finally:
+            # Free the blocks already read if the consumer stops early
+            for item, fut in inflight:
+                shm, size = fut.result()
+                if shm is not None:
+                    release_shared(shm)
+
+
 # Calculates all possible hashes for a single file
 # (normal, and all possible rotations)
 # Just image data, ignore headers
-# Uses a process pool to benefit from multiple cores
-def hashcalc(path, pool, method="MD5", havejpeginfo=False):
+# x is a tuple with the format
+# (shared memory block name,data size,hash_method,path,havejpeginfo)
+# This is the function that will be executed in the process pool, reading
+# the file contents already loaded in shared memory by the I/O threads
+def hashcalc(x):
+    name, size, method, path, havejpeginfo = x
     rotations = [0, 90, 180, 270]
 
     # Check file integrity using jpeginfo if available
@@ -103,25 +345,27 @@ def hashcalc(path, pool, method="MD5", havejpeginfo=False):
             sys.stderr.write("     Corrupt JPEG, skipping\n")
             return ["ERR"]
 
+    shm = attach_shared(name)
+    try:
+        data = bytes(shm.buf[:size])
+    finally:
+        shm.close()
+
     try:
-        img = JPEGImage(path)
+        img = JPEGImage(blob=data)
     except IOError:
         sys.stderr.write(
             "    *** Error opening file %s, file will be ignored\n" % path
         )
         return ["ERR"]
-    else:
-        lista = [(img, rot, method) for rot in rotations]
 
     try:
-        results = pool.map(phash, lista)
+        results = [phash((img, rot, method)) for rot in rotations]
     except:
         sys.stderr.write(
             "    *** Error reading image data, it will be ignored\n"
         )
         return ["ERR"]
-    del lista
-    del img
     return results
 
 
@@ -288,6 +532,13 @@ def parse_cmdline():
         action="store_true",
         required=False,
     )
+    parser.add_argument(
+        "-s",
+        "--stream",
+        help="Report duplicates as soon as they're found, while scanning, as one JSON object per line: either a new set of duplicates or a new member of an existing set",
+        action="store_true",
+        required=False,
+    )
     parser.add_argument(
         "-c",
         "--clean",
@@ -303,6 +554,62 @@ def parse_cmdline():
         choices=["MD5", "CRC"],
         required=False,
     )
+    parser.add_argument(
+        "--io-threads",
+        help="Number of threads reading files from disk (default: %d). Raising it may help on network filesystems" % IO_THREADS,
+        default=IO_THREADS,
+        type=int,
+        required=False,
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        help="Number of processes calculating hashes (default: number of CPUs)",
+        default=None,
+        type=int,
+        required=False,
+    )
+    parser.add_argument(
+        "--memory-limit",
+        help="Memory used for grouping signatures before spilling them to temporary files, in MB (default: %d)" % MEMORY_LIMIT,
+        default=MEMORY_LIMIT,
+        type=int,
+        required=False,
+    )
+    parser.add_argument(
+        "--max-read-rate",
+        help="Maximum read rate from disk, in MB/s (default: unlimited)",
+        default=None,
+        type=float,
+        required=False,
+    )
+    parser.add_argument(
+        "--max-file-rate",
+        help="Maximum number of files read per second (default: unlimited)",
+        default=None,
+        type=float,
+        required=False,
+    )
+    parser.add_argument(
+        "--backoff",
+        help="Slow down reads while read latency is much higher than usual, e.g. when shared storage is busy",
+        action="store_true",
+        required=False,
+    )
+    parser.add_argument(
+        "--nice",
+        help="Nice value for the threads and processes reading and hashing files",
+        default=None,
+        type=int,
+        required=False,
+    )
+    parser.add_argument(
+        "--ionice",
+        help="I/O scheduling class for the threads and processes reading and hashing files",
+        default=None,
+        choices=list(IONICE_CLASSES),
+        required=False,
+    )
     parser.add_argument(
         "--version", action="version", version="%(prog)s " + VERSION
     )
@@ -324,8 +631,9 @@ def is_jpeginfo_installed():
     return havejpeginfo
 
 
-def load_hashes(fsigs):
+def load_hashes(fsigs, root="."):
     # Reload hash data from previous run, if it exists
+    # Paths in the cache are relative to root
 
     jpegs = {}
     # This flag indicates if there is anything to update in the cache
@@ -340,7 +648,7 @@ def load_hashes(fsigs):
             # Clean up non-existing entries
             sys.stderr.write("Updating cache, removing deleted files from cache...\n")
             jpegs = dict(
-                [x for x in iter(jpegs.items()) if os.path.exists(x[0])]
+                [x for x in iter(jpegs.items()) if os.path.exists(os.path.join(root, x[0]))]
             )
         except (
             pickle.UnpicklingError,
@@ -357,47 +665,58 @@ def load_hashes(fsigs):
     return jpegs, modif
 
 
-def calculate_hashes(jpegs, modif, havejpeginfo, fsigs, clean, hash_method):
+# Walks the directory tree under root, yielding
+# (full path, path, name, dir, size) tuples for JPEG files not in the
+# signatures cache (or whose size has changed). path and dir are relative
+# to root, as stored in the cache.
+# Files are yielded in inode order within each directory, which usually
+# follows their layout on disk and keeps reads as sequential as possible.
+# Records already in the cache are passed to on_record as they're found
+def files_to_hash(root, jpegs, on_record=None):
     extensions = ("jpg", "jpeg") # Allowed extensions (case insensitive)
-    # Create process pool for parallel hash calculation
-    with a_thread_pool() as pool:
-        count = 0
-        for dirName, subdirList, fileList in os.walk("."):
-            sys.stderr.write("Exploring %s\n" % dirName)
-            for fname in fileList:
-                # Update signatures cache every 100 files
-                if modif and ((count % 100) == 0):
-                    writecache(jpegs, clean, fsigs)
-                    modif = False
-                if fname.lower().endswith(extensions):
-                    filepath = os.path.join(dirName, fname)
-                    # Si el fichero no está en la caché,
-                    # o está pero con tamaño diferente, añadirlo
-                    if (filepath not in jpegs) or (jpegs[filepath]["size"] != os.path.getsize(filepath)):
-                        sys.stderr.write("   Calculating hash of %s\n" % filepath)
-                        jpegs[filepath] = {
-                            "name": fname,
-                            "dir": dirName,
-                            "hash": hashcalc(
-                                filepath, pool, hash_method, havejpeginfo
-                            ),
-                            "size": os.path.getsize(filepath),
-                        }
-                        modif = True
-                        count += 1
-
-    return jpegs, modif, count
-
-
-def get_hashes(rootDir, havejpeginfo, hash_method, clean):
-    with in_dir(rootDir):
-        fsigs = "." + JPEG_CACHE_FILE
-        jpegs, modif = load_hashes(fsigs)
-        jpegs, modif, count = calculate_hashes(jpegs, modif, havejpeginfo, fsigs, clean, hash_method)
-    # Write hash cache to disk
-        if modif:
-            writecache(jpegs, clean, fsigs)
-    return jpegs, modif, count
+    for fullDir, subdirList, fileList in os.walk(root):
+        reldir = os.path.relpath(fullDir, root)
+        dirName = "." if reldir == "." else os.path.join(".", reldir)
+        sys.stderr.write("Exploring %s\n" % dirName)
+        pending = []
+        for fname in fileList:
+            if fname.lower().endswith(extensions):
+                filepath = os.path.join(dirName, fname)
+                fullpath = os.path.join(fullDir, fname)
+                try:
+                    st = os.stat(fullpath)
+                except OSError:
+                    continue
+                # Si el fichero no está en la caché,
+                # o está pero con tamaño diferente, añadirlo
+                if (filepath not in jpegs) or (jpegs[filepath]["size"] != st.st_size):
+                    pending.append((st.st_ino, fullpath, filepath, fname, st.st_size))
+                elif on_record is not None:
+                    on_record(filepath, jpegs[filepath])
+        pending.sort()
+        for ino, fullpath, filepath, fname, size in pending:
+            yield fullpath, filepath, fname, dirName, size
+
+
+# Waits for the hash of a file submitted to the process pool, frees its
+# shared memory block and returns the new record for the file
+def collect_hash(entry):
+    (fullpath, filepath, fname, dirName, size), shm, result = entry
+    try:
+        h = result.result()
+    except:
+        sys.stderr.write(
+            "    *** Error reading image data, it will be ignored\n"
+        )
+        h = ["ERR"]
+    finally:
+        release_shared(shm)
+    return {
+        "name": fname,
+        "dir": dirName,
+        "hash": h,
+        "size": size,
+    }
 
 
 def get_terminal_width():
@@ -407,6 +726,433 @@ def get_terminal_width():
     return colsize
 
 
+# Returns only the hashes that could be generated, skipping errors
+def valid_hashes(hashes):
+    return [h for h in hashes if isinstance(h, (bytes, int))]
+
+
+# Groups (hash, file id) pairs by hash using a bounded amount of memory.
+# Pairs are buffered as fixed-width records and, when the buffer reaches
+# the memory limit, sorted and spilled to a temporary file (a run). Runs are
+# k-way merged at the end to find the hashes shared by several files
+class SignatureGrouper:
+    def __init__(self, memory_limit=MEMORY_LIMIT, tmpdir=None):
+        # Each buffered record costs a bytes object plus a list slot
+        recsize = sys.getsizeof(bytes(GROUP_RECORD.size)) + 8
+        self.maxrecords = max(1, int(memory_limit * 1024 * 1024) // recsize)
+        self.tmpdir = tmpdir
+        self.buffer = []
+        self.runs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        for run in self.runs:
+            run.close()
+        self.runs = []
+        self.buffer = []
+
+    def add(self, h, fileid):
+        if isinstance(h, int):
+            h = h.to_bytes(GROUP_RECORD.size - 8, "big")
+        self.buffer.append(GROUP_RECORD.pack(h, fileid))
+        if len(self.buffer) >= self.maxrecords:
+            self.spill()
+
+    def spill(self):
+        self.buffer.sort()
+        run = tempfile.TemporaryFile(dir=self.tmpdir)
+        for rec in self.buffer:
+            run.write(rec)
+        run.seek(0)
+        self.runs.append(run)
+        self.buffer = []
+
+    def read_run(self, run):
+        for rec in iter(lambda: run.read(GROUP_RECORD.size), b""):
+            yield rec
+
+    def groups(self):
+        """Yields sorted lists with the ids of the files sharing each hash,
+        skipping hashes that belong to a single file."""
+        if self.runs:
+            if self.buffer:
+                self.spill()
+            records = heapq.merge(*[self.read_run(r) for r in self.runs])
+        else:
+            self.buffer.sort()
+            records = iter(self.buffer)
+        for h, recs in itertools.groupby(records, key=lambda r: r[:-8]):
+            ids = sorted({GROUP_RECORD.unpack(r)[1] for r in recs})
+            if len(ids) > 1:
+                yield ids
+
+
+# Finds the root of x in the union-find forest stored in parent
+def find_root(parent, x):
+    root = x
+    while parent[root] != root:
+        root = parent[root]
+    # Path compression
+    while parent[x] != root:
+        parent[x], x = root, parent[x]
+    return root
+
+
+# Joins groups of file ids sharing some hash into sets of duplicates. The
+# same files usually show up once per rotation, and only the files in some
+# group are held in memory. Returns a list of sorted lists of ids
+def duplicate_sets(groups):
+    parent = {}
+    for ids in groups:
+        for i in ids:
+            parent.setdefault(i, i)
+        root = find_root(parent, ids[0])
+        for i in ids[1:]:
+            parent[find_root(parent, i)] = root
+    sets = defaultdict(list)
+    for i in parent:
+        sets[find_root(parent, i)].append(i)
+    return sorted(sorted(ids) for ids in sets.values())
+
+
+# Online index of duplicate sets, fed one file at a time while the tree is
+# still being scanned. Only hashes and paths are kept, not the full records
+class DuplicateIndex:
+    def __init__(self):
+        # Cluster of files for each hash. Clusters are dicts with the list
+        # of files and their set number, assigned once they have duplicates
+        self.clusters = {}
+        self.nsets = 0
+
+    def add(self, path, hashes):
+        """Adds a file to the index, returning a list of the events it causes:
+        a new set of duplicates, or a new member of an existing set."""
+        # Skip hashes that couldn't be generated
+        hashes = valid_hashes(hashes)
+        found = []
+        for h in hashes:
+            c = self.clusters.get(h)
+            if c is not None and not any(c is x for x in found):
+                found.append(c)
+        if not found:
+            cluster = {"set": None, "files": [path]}
+            for h in hashes:
+                self.clusters[h] = cluster
+            return []
+
+        # Keep the numbering of existing sets if possible
+        found.sort(key=lambda c: c["set"] is None)
+        cluster = found[0]
+        newfiles = [path]
+        # The file links several clusters together, so merge them
+        for other in found[1:]:
+            for h, c in self.clusters.items():
+                if c is other:
+                    self.clusters[h] = cluster
+            newfiles += other["files"]
+        for h in hashes:
+            self.clusters[h] = cluster
+
+        if cluster["set"] is None:
+            self.nsets += 1
+            cluster["set"] = self.nsets
+            cluster["files"] += newfiles
+            return [{"event": "set", "set": cluster["set"], "files": list(cluster["files"])}]
+        cluster["files"] += newfiles
+        return [
+            {"event": "member", "set": cluster["set"], "file": f}
+            for f in newfiles
+        ]
+
+
+# Prints index events as NDJSON, flushing so they can be piped right away
+def print_events(events):
+    for e in events:
+        print(json.dumps(e), flush=True)
+
+
+# Runs a synchronous iterator in a worker thread, one item at a time, so it
+# can be consumed with "async for" without blocking the event loop
+async def aiterate(it):
+    loop = asyncio.get_running_loop()
+    done = object()
+    try:
+        while True:
+            item = await loop.run_in_executor(None, next, it, done)
+            if item is done:
+                break
+            yield item
+    finally:
+        if hasattr(it, "close"):
+            await loop.run_in_executor(None, it.close)
+
+
+class SignatureIndex:
+    """ Signatures of the JPEG files under a root directory, loaded from and
+        saved to the signatures cache file in that directory.
+        Records are indexed by their path relative to the root directory
+        (e.g. "./subdir/file.jpg"), the same way they're stored in the cache.
+    """
+
+    def __init__(self, root, clean=False):
+        self.root = root
+        self.clean = clean
+        self.fsigs = root + JPEG_CACHE_FILE
+        self.jpegs, self.modif = load_hashes(self.fsigs, root)
+
+    def __len__(self):
+        return len(self.jpegs)
+
+    def __contains__(self, path):
+        return path in self.jpegs
+
+    def __getitem__(self, path):
+        return self.jpegs[path]
+
+    def records(self):
+        """ Iterates over (path, record) tuples. """
+        return iter(self.jpegs.items())
+
+    def fullpath(self, path):
+        """ Path of a file from the current directory. """
+        return os.path.normpath(os.path.join(self.root, path))
+
+    def add(self, path, record):
+        self.jpegs[path] = record
+        self.modif = True
+
+    def remove(self, path):
+        """ Deletes a file from disk and from the index. """
+        os.remove(self.fullpath(path))
+        del self.jpegs[path]
+        self.modif = True
+
+    def save(self):
+        """ Writes the signatures cache to disk, if there're changes. """
+        if self.modif:
+            writecache(self.jpegs, self.clean, self.fsigs)
+            self.modif = False
+
+    def duplicates(self, memory_limit=MEMORY_LIMIT):
+        """ Yields each set of duplicated files as a list of records, sorted by
+            path. Records are copies including a "path" field.
+        """
+        # Group files with the same hash together, identifying each file by
+        # its position in paths. Grouping spills to disk past the memory limit
+        paths = list(self.jpegs)
+        with SignatureGrouper(memory_limit) as grouper:
+            for fileid, f in enumerate(paths):
+                # Skip entries whose hash couldn't be generated, so they're not reported as duplicates
+                for h in valid_hashes(self.jpegs[f]["hash"]):
+                    grouper.add(h, fileid)
+            # Join the groups of each rotation into sets
+            dupsets = duplicate_sets(grouper.groups())
+        # Load only the records of files that have duplicates
+        for ids in dupsets:
+            dupset = [dict(self.jpegs[paths[i]], path=paths[i]) for i in ids]
+            dupset.sort(key=lambda k: k["path"])
+            yield dupset
+
+    def matches(self, library, memory_limit=MEMORY_LIMIT):
+        """ Yields the paths of files that also exist in the library index,
+            ignoring metadata, sorted by file name.
+        """
+        paths = sorted(self.jpegs, key=lambda fpath: self.jpegs[fpath]["name"])
+
+        # Group hashes of both indexes together: all library files get id 0,
+        # files in this index their position in paths plus one. Files
+        # grouped with id 0 exist in the library
+        found = set()
+        with SignatureGrouper(memory_limit) as grouper:
+            for path, jpeg in library.records():
+                for h in valid_hashes(jpeg["hash"]):
+                    grouper.add(h, 0)
+            for fileid, fpath in enumerate(paths, 1):
+                for h in valid_hashes(self.jpegs[fpath]["hash"]):
+                    grouper.add(h, fileid)
+            for ids in grouper.groups():
+                if ids[0] == 0:
+                    found.update(ids[1:])
+
+        for fileid, fpath in enumerate(paths, 1):
+            if fileid in found:
+                yield fpath
+
+
+class Scanner:
+    """ Calculates the signatures of the JPEG files under a root directory,
+        keeping them in a SignatureIndex.
+        Files are read by a small pool of I/O threads and handed to the hashing
+        processes through shared memory, so that both disk and CPUs stay busy.
+        Both pool sizes can be tuned independently (workers defaults to the
+        number of CPUs). A concurrent.futures executor may be given instead,
+        to be used for hashing, and it won't be shut down by the scanner.
+        Reads and worker priorities are scheduled by throttle, if given
+        (priorities don't apply to an executor given by the caller).
+        The current directory is never changed, so several scanners can run
+        concurrently in the same process.
+    """
+
+    def __init__(
+        self,
+        root,
+        hash_method="MD5",
+        havejpeginfo=False,
+        clean=False,
+        io_threads=IO_THREADS,
+        workers=None,
+        executor=None,
+        memory_limit=MEMORY_LIMIT,
+        throttle=None,
+    ):
+        if not os.path.isdir(root):
+            raise FileNotFoundError("Directory %s doesn't exist" % root)
+        self.root = root
+        self.hash_method = hash_method
+        self.havejpeginfo = havejpeginfo
+        self.io_threads = io_threads
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = executor
+        self.memory_limit = memory_limit
+        self.throttle = throttle
+        self.index = SignatureIndex(root, clean)
+        # Number of hashes calculated in the last scan
+        self.count = 0
+
+    def __iter__(self):
+        return self.scan()
+
+    def __aiter__(self):
+        return aiterate(self.scan())
+
+    def store(self, path, record, keep):
+        if keep:
+            self.index.add(path, record)
+        self.count += 1
+        # Update signatures cache every 100 files
+        if (self.count % 100) == 0:
+            self.index.save()
+        return path, record
+
+    def scan(self, keep=True):
+        """ Walks the root directory yielding (path, record) tuples for every
+            JPEG file, as soon as its hashes are known, either from the cache
+            or just calculated. If keep is False, new records aren't added to
+            the index (useful when they're only streamed).
+        """
+        self.count = 0
+        maxpending = self.workers * READAHEAD_DEPTH
+        cached = deque()
+        pending = deque()
+        # Create process pool for parallel hash calculation
+        with a_thread_pool(self.workers, self.executor, self.throttle) as pool:
+            files = read_ahead(
+                files_to_hash(self.root, self.index.jpegs, lambda path, record: cached.append((path, record))),
+                self.io_threads,
+                self.io_threads + maxpending,
+                self.throttle,
+            )
+            try:
+                for item, shm, size in files:
+                    while cached:
+                        yield cached.popleft()
+                    fullpath = item[0]
+                    sys.stderr.write("   Calculating hash of %s\n" % item[1])
+                    if shm is None:
+                        sys.stderr.write(
+                            "    *** Error opening file %s, file will be ignored\n" % fullpath
+                        )
+                        record = {
+                            "name": item[2],
+                            "dir": item[3],
+                            "hash": ["ERR"],
+                            "size": item[4],
+                        }
+                    else:
+                        result = pool.submit(
+                            hashcalc,
+                            (shm.name, size, self.hash_method, fullpath, self.havejpeginfo),
+                        )
+                        pending.append((item, shm, result))
+                        if len(pending) < maxpending:
+                            continue
+                        item = pending[0][0]
+                        record = collect_hash(pending.popleft())
+                    yield self.store(item[1], record, keep)
+                while pending:
+                    item = pending[0][0]
+                    yield self.store(item[1], collect_hash(pending.popleft()), keep)
+                while cached:
+                    yield cached.popleft()
+            finally:
+                # Free what's left if the consumer stops early
+                files.close()
+                for item, shm, result in pending:
+                    result.cancel()
+                    release_shared(shm)
+        # Write hash cache to disk
+        self.index.save()
+
+    def duplicates(self):
+        """ Scans the root directory and yields each set of duplicated files,
+            as a list of records sorted by path.
+        """
+        for path, record in self.scan():
+            pass
+        yield from self.index.duplicates(self.memory_limit)
+
+    def duplicates_async(self):
+        """ Same as duplicates, as an async iterator. """
+        return aiterate(self.duplicates())
+
+
+# Creates the read scheduler requested in the command line, if any
+def cli_throttle(args):
+    if not (args.max_read_rate or args.max_file_rate or args.backoff or args.nice is not None or args.ionice):
+        return None
+    return Throttle(
+        args.max_read_rate * 1024 * 1024 if args.max_read_rate else None,
+        args.max_file_rate,
+        args.backoff,
+        args.nice,
+        args.ionice,
+    )
+
+
+# Prints throttling statistics at the end of the run
+def print_throttle_stats(throttle):
+    if throttle is None:
+        return
+    st = throttle.stats()
+    sys.stderr.write(
+        "Throttling: read %d files, %.1f MB in %.1f s (%.2f MB/s, %.1f files/s), waited %.1f s, %d backoffs\n"
+        % (
+            st["files"],
+            st["bytes"] / 1024 / 1024,
+            st["elapsed"],
+            st["bytes_rate"] / 1024 / 1024,
+            st["files_rate"],
+            st["waited"],
+            st["backoffs"],
+        )
+    )
+
+
+# Creates a scanner for a directory given in the command line,
+# exiting if it doesn't exist
+def cli_scanner(directory, **kwargs):
+    try:
+        return Scanner(directory, **kwargs)
+    except FileNotFoundError:
+        sys.stderr.write("Directory %s doesn't exist\n" % directory)
+        exit(1)
+
+
 def remove_duplicates(args):
     if args.auto and not args.delete:
         sys.stderr.write(
@@ -417,55 +1163,31 @@ def remove_duplicates(args):
     # Check if jpeginfo is installed
     havejpeginfo = is_jpeginfo_installed()
 
-    # TODO should use the in_dir context manager here
-    pwd = os.getcwd()
-    try:
-        os.chdir(args.directory)
-    except:
-        sys.stderr.write("Directory %s doesn't exist\n" % args.directory)
-        exit(1)
+    scanner = cli_scanner(
+        args.directory,
+        hash_method=args.method,
+        havejpeginfo=havejpeginfo,
+        clean=args.clean,
+        io_threads=args.io_threads,
+        workers=args.workers,
+        memory_limit=args.memory_limit,
+        throttle=cli_throttle(args),
+    )
+    index = scanner.index
 
     colsize = get_terminal_width()
 
-    rootDir = "."
-    jpegs, modif, count = get_hashes(rootDir, havejpeginfo, args.method, args.clean)
-    fsigs = rootDir + JPEG_CACHE_FILE
     # Check for duplicates
-
-    # Create a new dict indexed by hash
-    hashes = defaultdict(list)
-    
-    # Group files with the same hash together
-    for f in jpegs:
-        for h in jpegs[f]["hash"]:
-            # Skip entries whose hash couldn't be generated, so they're not reported as duplicates
-            if "ERR" != h:
-                hashes[h].append(jpegs[f])
-
-    # Discard hashes without duplicates
-    dupes = {}
-    for h in hashes:
-        if len(hashes[h]) > 1:
-            dupes[h] = hashes[h]
-
-    # Discard duplicated sets (probably a lot if --rotations is activated)
-    nodupes = []
-    for elem in list(dupes.values()):
-        if not elem in nodupes:
-            nodupes.append(elem)
-    # Cleanup. Not strictly necessary,
-    # but if there're a lot of files these can get quite big
-    del hashes, dupes
+    nodupes = list(scanner.duplicates())
+    print_throttle_stats(scanner.throttle)
 
     seperator = " " if args.sameline else "\n"
 
     nset = 1
     tmpdirs = []
     for dupset in nodupes:
-        # Add path field (for convenience) and sort by file path
-        for d in dupset:
-            d.update({"path": os.path.join(d["dir"], d["name"])})
-        dupset.sort(key=lambda k: k["path"])
+        # Records have a path field (relative to the scanned directory)
+        # and are sorted by it
         print()
         if args.delete:
             # Calculate best guess for auto mode
@@ -478,7 +1200,7 @@ def remove_duplicates(args):
             # or the one with shorter path if tags are equal
             # (due to previous sort)
             bestguess = dupaux.index(
-                max(dupaux, key=lambda k: len(metadata_summary(k)["tags"]))
+                max(dupaux, key=lambda k: len(metadata_summary(index.fullpath(k))["tags"]))
             )
 
             optselected = False
@@ -507,7 +1229,7 @@ def remove_duplicates(args):
                 ]
                 for i in range(len(dupset)):
                     aux = dupset[i]
-                    md = metadata_summary(aux["path"])
+                    md = metadata_summary(index.fullpath(aux["path"]))
                     rws.append(
                         [
                             "*" if i == bestguess else " ",
@@ -531,9 +1253,7 @@ def remove_duplicates(args):
                     )
                 if answer in ["detail", "d"]:
                     # Show detailed differences in EXIF tags
-                    filelist = [
-                        os.path.join(x["dir"], x["name"]) for x in dupset
-                    ]
+                    filelist = [index.fullpath(x["path"]) for x in dupset]
                     metadata_comp_table(filelist)
                 elif answer in ["help", "h"]:
                     print()
@@ -553,8 +1273,7 @@ def remove_duplicates(args):
                     print()
                 elif answer in ["quit", "q"]:
                     # If asked, write changes, delete temps and quit
-                    if modif:
-                        writecache(jpegs, args.clean, fsigs)
+                    index.save()
                     rmtemps(tmpdirs)
                     exit(0)
                 elif answer in ["show", "s"]:
@@ -563,7 +1282,7 @@ def remove_duplicates(args):
                     tmpdir = tempfile.mkdtemp()
                     tmpdirs.append(tmpdir)
                     for i in range(len(dupset)):
-                        p = dupset[i]["path"]
+                        p = index.fullpath(dupset[i]["path"])
                         ntemp = "%d_%s" % (i, dupset[i]["name"])
                         shutil.copyfile(p, os.path.join(tmpdir, ntemp))
                     sub.Popen(["xdg-open", tmpdir], stdout=None, stderr=None)
@@ -585,10 +1304,7 @@ def remove_duplicates(args):
                     answer = int(answer)
                     for i in range(len(dupset)):
                         if i != answer:
-                            p = dupset[i]["path"]
-                            os.remove(p)
-                            del jpegs[p]
-                            modif = True
+                            index.remove(dupset[i]["path"])
                     sys.stderr.write(
                         "Kept %s, deleted others\n" % (dupset[answer]["name"])
                     )
@@ -602,53 +1318,89 @@ def remove_duplicates(args):
 
 
     # Final update of the cache in order to remove signatures of deleted files
-    if modif:
-        writecache(jpegs, args.clean, fsigs)
+    index.save()
 
     # Delete temps
     rmtemps(tmpdirs)
 
-    # Restore directory
-    os.chdir(pwd)
 
+def stream_duplicates(args):
+    """ Report duplicates as NDJSON on stdout while the tree is being scanned,
+        one line per new set of duplicates or new member of an existing set.
+    """
+    havejpeginfo = is_jpeginfo_installed()
+    scanner = cli_scanner(
+        args.directory,
+        hash_method=args.method,
+        havejpeginfo=havejpeginfo,
+        clean=args.clean,
+        io_threads=args.io_threads,
+        workers=args.workers,
+        throttle=cli_throttle(args),
+    )
+    index = DuplicateIndex()
+    # Records are only needed afterwards to update the signatures cache
+    for path, record in scanner.scan(keep=not args.clean):
+        print_events(index.add(path, record["hash"]))
+    print_throttle_stats(scanner.throttle)
 
-def filter_folder(tofilter, library, delete, hash_method="MD5", clean=False):
+
+def filter_folder(tofilter, library, delete, hash_method="MD5", clean=False, io_threads=IO_THREADS, workers=None, memory_limit=MEMORY_LIMIT, throttle=None):
     """ Scan the tofilter folder and remove any jpegs from there that exist in the library folder as well, ignoring metadata.
         Nothing will be deleted from the library folder.
     """
     
     havejpeginfo = is_jpeginfo_installed()
     
-    # calculate hashes or load from file for tofilter dir
-    jpegs_tofilter, _ , tofilter_count = get_hashes(tofilter, havejpeginfo, hash_method, clean)  # jpegs, modif, count
-    # calculate hashes or load from file for library dir
-    jpegs_library, _ , library_count = get_hashes(library, havejpeginfo, hash_method, clean)    # jpegs, modif, count
-    hashes_library = [h for jpeg in jpegs_library.values() for h in jpeg['hash']]
+    scanners = [
+        cli_scanner(
+            d,
+            hash_method=hash_method,
+            havejpeginfo=havejpeginfo,
+            clean=clean,
+            io_threads=io_threads,
+            workers=workers,
+            memory_limit=memory_limit,
+            throttle=throttle,
+        )
+        for d in (tofilter, library)
+    ]
+    # calculate hashes or load from file for both dirs
+    for scanner in scanners:
+        for path, record in scanner.scan():
+            pass
+    print_throttle_stats(throttle)
+    tofilter_index, library_index = [scanner.index for scanner in scanners]
 
     if not delete:
         sys.stderr.write("No files will be deleted, only printed instead. Run with --delete to delete them\n")
     sys.stderr.write("Files to be deleted:\n")
 
     delete_count = 0
-    # for each hash in tofilter dir, if it exist in library, delete the corresponding file from tofilter dir
-    for fpath, jpeg in sorted(jpegs_tofilter.items(), key=lambda tup:tup[1]['name']):
-        for h in jpeg['hash']:
-            if h in hashes_library:
-                delete_count += 1
-                print(fpath)
-                if delete:
-                    os.remove(tofilter + os.path.sep + fpath)
-                break
+    # for each file in tofilter dir with a hash that exists in library, delete it from tofilter dir
+    for fpath in list(tofilter_index.matches(library_index, memory_limit)):
+        delete_count += 1
+        print(fpath)
+        if delete:
+            tofilter_index.remove(fpath)
+    tofilter_index.save()
 
     # print summary
-    sys.stderr.write(f"Nr hashes calculated, tofilter: {tofilter_count},  library: {library_count}\n")
+    sys.stderr.write(f"Nr hashes calculated, tofilter: {scanners[0].count},  library: {scanners[1].count}\n")
     sys.stderr.write("Nr files " + ("" if delete else "that would be ") + f"deleted {delete_count}\n")
 
 
 def main():
     args = parse_cmdline()
-    if args.library is not None:
-        filter_folder(args.directory, args.library, args.delete, args.method, args.clean)
+    if args.stream and (args.delete or args.library is not None):
+        sys.stderr.write(
+            "'--stream' can't be used with '-d', '--delete' or '--library'\n"
+        )
+        exit(1)
+    if args.stream:
+        stream_duplicates(args)
+    elif args.library is not None:
+        filter_folder(args.directory, args.library, args.delete, args.method, args.clean, args.io_threads, args.workers, args.memory_limit, cli_throttle(args))
     else:
         remove_duplicates(args)
 
@@ -0,0 +1,69 @@
+import hashlib
+import resource
+import subprocess
+import sys
+from collections import defaultdict
+
+from jpegdupes import jpegdupes
+
+
+""" Measures peak memory (RSS) when grouping a growing number of signatures,
+    using the out-of-core SignatureGrouper and the plain dict it replaced.
+    Peak memory should stay flat for the grouper as input size grows.
+    To run it, from the root of the repository:
+    python -m tests.bench_grouping
+"""
+
+SIZES = (250000, 1000000, 4000000)
+MEMORY_LIMIT = 32  # MB
+
+
+# Fake signatures: 4 per file (one per rotation), with one file out of 1000
+# duplicated
+def signatures(n):
+    for fileid in range(n):
+        base = fileid - 1 if fileid % 1000 == 1 else fileid
+        for rot in range(4):
+            yield hashlib.md5(b"%d-%d" % (base, rot)).digest(), fileid
+
+
+def run_grouper(n):
+    with jpegdupes.SignatureGrouper(MEMORY_LIMIT) as grouper:
+        for h, fileid in signatures(n):
+            grouper.add(h, fileid)
+        return len(jpegdupes.duplicate_sets(grouper.groups()))
+
+
+def run_dict(n):
+    hashes = defaultdict(list)
+    for h, fileid in signatures(n):
+        hashes[h].append(fileid)
+    groups = [ids for ids in hashes.values() if len(ids) > 1]
+    return len(jpegdupes.duplicate_sets(groups))
+
+
+def measure(engine, n):
+    """ Runs one engine in a fresh process, returning (sets found, peak RSS in MB). """
+    out = subprocess.check_output(
+        [sys.executable, "-m", "tests.bench_grouping", engine, str(n)]
+    )
+    nsets, rss = out.split()
+    return int(nsets), int(rss) / 1024
+
+
+def main():
+    if len(sys.argv) == 3:
+        engine, n = sys.argv[1], int(sys.argv[2])
+        nsets = run_grouper(n) if engine == "grouper" else run_dict(n)
+        print(nsets, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+        return
+
+    print("%12s %10s %16s %16s" % ("signatures", "sets", "grouper (MB)", "dict (MB)"))
+    for n in SIZES:
+        nsets, rss_grouper = measure("grouper", n)
+        _, rss_dict = measure("dict", n)
+        print("%12d %10d %16.1f %16.1f" % (n * 4, nsets, rss_grouper, rss_dict))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 import unittest
-import os, shutil
+import asyncio
+import os, shutil, tempfile, time
+from concurrent.futures import ThreadPoolExecutor
 from jpegdupes import jpegdupes
 # import jpegdupes.jpegdupes
 
@@ -47,6 +49,14 @@ class TestJpegDupes(unittest.TestCase):
         args.clean = False
         args.sameline = True
         args.method = "MD5"
+        args.io_threads = 2
+        args.workers = None
+        args.memory_limit = 1
+        args.max_read_rate = None
+        args.max_file_rate = None
+        args.backoff = False
+        args.nice = None
+        args.ionice = None
 
         # for some unkown reason the line
         # colsize = int(os.popen("stty size", "r").read().split()[1])
@@ -75,3 +85,87 @@ class TestJpegDupes(unittest.TestCase):
         self.assertTrue(os.path.isfile(library  + jpegdupes.JPEG_CACHE_FILE), "File not found {}".format(library + jpegdupes.JPEG_CACHE_FILE))
         self.assertTrue(os.path.isfile(tofilter + jpegdupes.JPEG_CACHE_FILE), "File not found {}".format(tofilter + jpegdupes.JPEG_CACHE_FILE))
 
+    def test_read_ahead(self):
+        """ Files should be read into shared memory and yielded in the same order they were requested. """
+        paths = sorted(self.IMAGES_DIR + os.path.sep + img for img in os.listdir(self.IMAGES_DIR))
+        paths.append(self.IMAGES_DIR + "/missing.jpg")
+        items = [(p,) for p in paths]
+        results = list(jpegdupes.read_ahead(items, io_threads=2, depth=3))
+
+        self.assertEqual([r[0] for r in results], items)
+        for (p,), shm, size in results[:-1]:
+            with open(p, "rb") as f:
+                self.assertEqual(bytes(shm.buf[:size]), f.read(), p)
+            jpegdupes.release_shared(shm)
+        self.assertEqual(results[-1][1:], (None, 0))
+
+    def test_duplicate_index(self):
+        """ Duplicate sets should be reported as soon as the second file arrives, and later files as new members. """
+        index = jpegdupes.DuplicateIndex()
+        self.assertEqual(index.add("a.jpg", [b"1", b"2", b"3", b"4"]), [])
+        self.assertEqual(index.add("b.jpg", ["ERR"]), [])
+        self.assertEqual(index.add("c.jpg", [b"3", b"4", b"1", b"2"]),
+                         [{"event": "set", "set": 1, "files": ["a.jpg", "c.jpg"]}])
+        self.assertEqual(index.add("d.jpg", [b"5", b"6", b"7", b"8"]), [])
+        self.assertEqual(index.add("e.jpg", [b"2", b"1", b"4", b"3"]),
+                         [{"event": "member", "set": 1, "file": "e.jpg"}])
+
+    def test_signature_grouper(self):
+        """ Hashes shared by several files should be found both in memory and when spilling to disk. """
+        for memory_limit in (1, 0.001):
+            with jpegdupes.SignatureGrouper(memory_limit) as grouper:
+                for i in range(100):
+                    grouper.add(bytes([i]) * 16, i)
+                    grouper.add(i, i)
+                grouper.add(bytes([7]) * 16, 200)
+                grouper.add(42, 100)
+                grouper.add(42, 101)
+                self.assertEqual(len(grouper.runs) > 0, memory_limit < 1)
+                self.assertEqual(sorted(grouper.groups()), [[7, 200], [42, 100, 101]])
+
+    def test_duplicate_sets(self):
+        """ Groups sharing some file should be joined into a single set. """
+        groups = [[1, 2], [5, 9], [2, 3], [1, 2]]
+        self.assertEqual(jpegdupes.duplicate_sets(groups), [[1, 2, 3], [5, 9]])
+
+    def test_scanner(self):
+        """ Scanners should work on explicit paths, so several can run concurrently without changing the current directory. """
+        cwd = os.getcwd()
+        roots = [tempfile.mkdtemp() for i in range(2)]
+        try:
+            for root in roots:
+                shutil.copytree(self.IMAGES_DIR, root + "/images")
+            scanners = [jpegdupes.Scanner(root, clean=True) for root in roots]
+            with ThreadPoolExecutor(2) as executor:
+                results = list(executor.map(lambda s: list(s.duplicates()), scanners))
+            self.assertEqual(os.getcwd(), cwd)
+            for root, scanner, dupsets in zip(roots, scanners, results):
+                self.assertEqual(len(scanner.index), len(os.listdir(self.IMAGES_DIR)))
+                paths = [[d["path"] for d in dupset] for dupset in dupsets]
+                self.assertIn(["./images/donatello.jpg", "./images/donatello2.jpg"], paths)
+                self.assertFalse(os.path.exists(root + jpegdupes.JPEG_CACHE_FILE))
+
+            async def scan(scanner):
+                return [path async for path, record in scanner]
+            paths = asyncio.run(scan(jpegdupes.Scanner(roots[0], clean=True)))
+            self.assertEqual(sorted(paths), sorted("./images/" + img for img in os.listdir(self.IMAGES_DIR)))
+        finally:
+            for root in roots:
+                shutil.rmtree(root)
+
+    def test_throttle(self):
+        """ Reads should be kept within the files/sec budget, and statistics collected. """
+        throttle = jpegdupes.Throttle(files_rate=20)
+        paths = sorted(self.IMAGES_DIR + os.path.sep + img for img in os.listdir(self.IMAGES_DIR))
+        items = [(p,) for p in paths] * 5
+        start = time.monotonic()
+        for item, shm, size in jpegdupes.read_ahead(items, io_threads=2, depth=3, throttle=throttle):
+            jpegdupes.release_shared(shm)
+        elapsed = time.monotonic() - start
+
+        stats = throttle.stats()
+        self.assertEqual(stats["files"], len(items))
+        self.assertEqual(stats["bytes"], 5 * sum(os.path.getsize(p) for p in paths))
+        # The first second worth of files is a burst
+        self.assertGreaterEqual(elapsed, (len(items) - 20) / 20 * 0.9)
+        self.assertGreater(stats["waited"], 0)